@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 """Functions for fetching, creating, and opening raw and processed data files."""
 
+from io import BytesIO
 from os import mkdir
 from os.path import isdir
 
-from numpy import asarray, delete, where
+from numpy import asarray, concatenate, delete, empty, float64, int64, where
 from pandas import read_csv
 
 
@@ -48,14 +49,31 @@ def write_wig(wig_track, wig_file_name, chrom_name):
         - wig_track (required) - the wig data you wish to write (in 2xn array)
         - wig_file_name (string) - the new file you will write to
     """
-    validate_reads(wig_track)
-    d_inds = where(wig_track[:, 0] < 1)
-    wig_track = delete(wig_track, d_inds, axis=0)
+    write_wig_chroms({chrom_name: wig_track}, wig_file_name)
+
+
+def write_wig_chroms(tracks_by_chrom, wig_file_name):
+    """Write the data of one or more chromosomes to a single wig file.
+
+    Parameters
+    ----------
+        - tracks_by_chrom (dict) - maps each chromosome name to the wig data
+            you wish to write for it (in 2xn array)
+        - wig_file_name (string) - the new file you will write to
+    """
+    for wig_track in tracks_by_chrom.values():
+        validate_reads(wig_track)
     with open(wig_file_name, "w+", encoding="utf-8") as wig_file:
         wig_file.write("track type=wiggle_0\n")
-        wig_file.write(f"variableStep chrom={chrom_name}\n")
-        for i in range(len(wig_track)):
-            wig_file.write(f"{int(wig_track[i,0])}\t{wig_track[i,1]}\n")
+        for chrom_name, wig_track in tracks_by_chrom.items():
+            d_inds = where(wig_track[:, 0] < 1)
+            wig_track = delete(wig_track, d_inds, axis=0)
+            wig_file.write(f"variableStep chrom={chrom_name}\n")
+            # tolist gives python numbers which format just as the numpy ones,
+            # so each chromosome's lines can be built and written in one go
+            locs = wig_track[:, 0].astype(int64).tolist()
+            vals = wig_track[:, 1].tolist()
+            wig_file.write("".join([f"{loc}\t{val}\n" for loc, val in zip(locs, vals)]))
 
 
 def open_wig(filename):
@@ -87,6 +105,62 @@ def open_wig(filename):
     return reads, chrom
 
 
+def open_wig_chroms(filename):
+    """Open a wig file holding one or more chromosomes.
+
+    Parameters
+    ----------
+        -filename (string) - required: the string containing the location of
+            the filename you desire to open!
+
+    Returns
+    -------
+        -reads_by_chrom (dict): maps each chromosome name, in file order, to a
+            2xn array with the first column being position and the second
+            column being the count at that position (raw read, z_score etc)
+    """
+    with open(filename, "rb") as file:
+        data = file.read()
+    # find the start of each variableStep line first, so that each chromosome's
+    # reads can be parsed as one block by read_csv rather than line by line
+    headers = []
+    start = data.find(b"variableStep")
+    while start != -1:
+        if start == 0 or data[start - 1 : start] == b"\n":
+            headers.append(start)
+        start = data.find(b"variableStep", start + 1)
+    if not headers:
+        raise ValueError(f"{filename} has no variableStep chromosome lines")
+
+    blocks_by_chrom = {}
+    for start, end in zip(headers, headers[1:] + [len(data)]):
+        body = data.find(b"\n", start, end)
+        body = end if body == -1 else body + 1
+        line = data[start:body].decode("utf8")
+        chrom = line[line.rfind("=") + 1 :].rstrip()
+        block = data[body:end]
+        if block.strip():
+            frame = read_csv(
+                BytesIO(block),
+                sep="\t",
+                header=None,
+                names=["bp", "count"],
+                dtype=float64,
+            )
+            # the frame keeps its columns apart, so copy the rows out C ordered
+            reads = asarray(frame, order="C")
+        else:
+            reads = empty((0, 2))
+        blocks_by_chrom.setdefault(chrom, []).append(reads)
+
+    reads_by_chrom = {}
+    for chrom, blocks in blocks_by_chrom.items():
+        reads = blocks[0] if len(blocks) == 1 else concatenate(blocks)
+        validate_reads(reads)
+        reads_by_chrom[chrom] = reads
+    return reads_by_chrom
+
+
 def make_new_dir(dir_parts):
     """Create a new directory and return valid path to it.
 
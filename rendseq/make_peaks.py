@@ -2,24 +2,146 @@
 """Take normalized raw data find the peaks in it."""
 
 import argparse
+import logging
 import sys
 import warnings
 from os.path import abspath
 
 import numpy as np
-from matplotlib import pyplot as plt
+from numba import njit, prange
 from scipy.stats import norm
 
-from rendseq.file_funcs import make_new_dir, open_wig, write_wig
+from rendseq.file_funcs import make_new_dir, open_wig_chroms, write_wig_chroms
+from rendseq.utility_funcs import map_chroms, split_reads
 
+logger = logging.getLogger(__name__)
 
-def _populate_trans_mat(z_scores, peak_center, spread, trans_m, states):
+# the z score grid searched for a kink, and the normal tail fraction above each
+_KINK_PNTS = np.arange(0, 20, 0.1)
+_KINK_TAIL = 1 - norm.cdf(_KINK_PNTS)
+
+# how the internal and peak states are represented in the wig file
+_STATES = np.array([1, 100], dtype=np.int16)
+
+
+@njit("(f8[:, ::1], f8[:, ::1])", nogil=True, cache=True)
+def _viterbi_forward(log_probs, log_trans):
+    """Run the forward pass of the Vertibi Algorithm.
+
+    Only the backpointers are kept for every position.  The path log
+    probabilities are carried forward a row at a time, as the backtrace only
+    needs the final row of them.
+
+    Parameters
+    ----------
+        -log_probs (nxS array): the log emission probability of each position
+            under each of the S states.
+        -log_trans (SxS array): the log transition probabilities between states.
+
+    Returns
+    -------
+        -final_log_probs (1xS array): the log probability of the most likely
+            path ending in each state at the last position.
+        -trans_2 (nxS array): the previous state on that most likely path.
+    """
+    n_pos, n_states = log_probs.shape
+    prev = np.ones(n_states)
+    cur = np.empty(n_states)
+    # a state index fits in a byte, keeping the backtrace table small
+    trans_2 = np.empty((n_pos, n_states), dtype=np.int8)
+    if n_pos == 0:
+        return prev, trans_2
+    trans_2[0, :] = 0
+    for i in range(1, n_pos):
+        for j in range(n_states):
+            # best path into state j: max_k(prev[k] + log_trans[k, j])
+            best = -np.inf
+            best_k = 0
+            for k in range(n_states):
+                path = prev[k] + log_trans[k, j]
+                if path > best:
+                    best = path
+                    best_k = k
+            cur[j] = best + log_probs[i, j]
+            trans_2[i, j] = best_k
+        prev, cur = cur, prev
+    return prev, trans_2
+
+
+@njit("(f8[::1], i1[:, ::1])", nogil=True, cache=True)
+def _viterbi_backtrace(final_log_probs, trans_2):
+    """Trace back the most likely path through the Vertibi matrices.
+
+    Parameters
+    ----------
+        -final_log_probs (1xS array): the log probability of the most likely
+            path ending in each state at the last position.
+        -trans_2 (nxS array): the previous state on that most likely path.
+
+    Returns
+    -------
+        -max_inds (1xn array): the index of the state at each position on the
+            most likely path.
+    """
+    n_pos = trans_2.shape[0]
+    max_inds = np.empty(n_pos, dtype=np.int8)
+    if n_pos == 0:
+        return max_inds
+    max_inds[-1] = np.argmax(final_log_probs)
+    for index in range(n_pos - 1, 0, -1):
+        max_inds[index - 1] = trans_2[index, max_inds[index]]
+    return max_inds
+
+
+@njit("(f8[:, :, ::1], i8[::1], f8[:, ::1])", parallel=True, cache=True)
+def _viterbi_batch(log_probs, lengths, log_trans):
+    """Run the Vertibi Algorithm on a batch of tracks in parallel.
+
+    Parameters
+    ----------
+        -log_probs (Bxnxs array): the log emission probabilities of each of the
+            B tracks, padded at the end to the length of the longest track.
+        -lengths (1xB array): the unpadded length of each track.
+        -log_trans (SxS array): the log transition probabilities between states.
+
+    Returns
+    -------
+        -max_inds (Bxn array): the index of the state at each position on the
+            most likely path of each track.
+        -final_log_probs (BxS array): the final path log probabilities of each
+            track.
+    """
+    n_tracks, n_pos, n_states = log_probs.shape
+    max_inds = np.zeros((n_tracks, n_pos), dtype=np.int8)
+    final_log_probs = np.empty((n_tracks, n_states))
+    for b in prange(n_tracks):
+        # an empty track has no path, and nothing to fill in
+        if lengths[b] == 0:
+            final_log_probs[b] = 0
+            continue
+        last, trans_2 = _viterbi_forward(log_probs[b, : lengths[b]], log_trans)
+        max_inds[b, : lengths[b]] = _viterbi_backtrace(last, trans_2)
+        final_log_probs[b] = last
+    return max_inds, final_log_probs
+
+
+def _log_trans(trans_m):
+    """Take the log of the transition matrix, mapping impossible moves to -inf.
+
+    This is done once per fit rather than inside the recurrence, and masking the
+    zero entries avoids numpy's divide by zero warning for them.
+    """
+    log_trans = np.full(np.shape(trans_m), -np.inf)
+    np.log(trans_m, out=log_trans, where=np.asarray(trans_m) > 0)
+    return log_trans
+
+
+def _populate_trans_mat(z_vals, peak_center, spread, trans_m, states):
     """Calculate the Vertibi Algorithm transition matrix.
 
     Parameters
     ----------
-        -z_scores (2xn array): - required: first column is position (ie bp
-            location) second column is a modified z_score for that position.
+        -z_vals (1xn array): - required: the modified z_score of each position.
         -peak_center (float): the mean of the emission probability distribution
             for the peak state.
         -spread (float): the standard deviation of the peak emmission
@@ -27,42 +149,42 @@ def _populate_trans_mat(z_scores, peak_center, spread, trans_m, states):
         -trans_m (matrix): the transition probabilities between states.
         -states (matrix): how internal and peak are represented in the wig file
 
+    Returns
+    -------
+        -final_log_probs (1xS array): the log probability of the most likely
+            path ending in each state at the last position.
+        -trans_2 (nxS array): the previous state on that most likely path.
+
     Raises
     ------
         -ValueError if the HMM parameters are unable to find any likely paths.
-            This is at risk of happening if the emission probabilities for
-            either the peak state or the internal state look very different from
-            the true distribution, or the parameters selected only allow a very
-            unlikely path - for example if p_to_p = 1 and you try to force the
-            system to stay in the peak state.
+            As emissions are computed as log probabilities this only happens
+            when some position has zero probability under every state, for
+            example a z_score of -inf.
     """
-    print("Calculating Transition Matrix")
-    trans_1 = np.zeros([len(states), len(z_scores)])
-    trans_2 = np.zeros([len(states), len(z_scores)]).astype(int)
-    trans_1[:, 0] = 1
-
-    # emission probabilities matrix (2 x n)
-    probs = np.zeros(shape=(len(states), len(z_scores)))
-    probs[0, :] = norm.pdf(
-        z_scores[:, 1]
-    )  # note zscores[:,1] is where all the zscores are
-    probs[1, :] = norm.pdf(z_scores[:, 1], peak_center, spread)
+    logger.debug("Calculating Transition Matrix")
+    # we use log probabilities for computational reasons. -Inf means 0 probability
+    log_trans = _log_trans(trans_m)
+
+    # log emission probabilities matrix (n x 2).  logpdf avoids the underflow to
+    # 0 that pdf hits in the tails.
+    # Positions are rows so each step of the recurrence reads contiguous memory.
+    # The columns are not memoized across calls: each is as long as the track,
+    # and the peak column changes with peak_center and spread anyway.
+    log_probs = np.empty(shape=(len(z_vals), len(states)))
+    log_probs[:, 0] = norm.logpdf(z_vals)
+    log_probs[:, 1] = norm.logpdf(z_vals, peak_center, spread)
 
     # Vertibi Algorithm:
-    for i in range(1, len(z_scores)):
-        # we use log probabilities for computational reasons. -Inf means 0 probability
-        paths = np.zeros((len(states), len(states)))
-        paths += np.expand_dims(
-            trans_1[:, i - 1], axis=1
-        )  # adds log(trans_1_sub) column-wise
-        paths += np.log(trans_m)  # adds log(trans_m) element-wise
-        paths += np.expand_dims(
-            np.log(probs[:, i]), axis=0
-        )  # adds log(probs_sub) row-wise
-        trans_2[:, i] = np.argmax(paths, axis=0)
-        trans_1[:, i] = np.max(paths, axis=0)
-
-    if np.any(np.isinf(trans_1[:, -1])):
+    final_log_probs, trans_2 = _viterbi_forward(log_probs, log_trans)
+
+    _check_valid_path(final_log_probs)
+    return final_log_probs, trans_2
+
+
+def _check_valid_path(final_log_probs):
+    """Raise a ValueError if no path ends with non-zero probability."""
+    if np.any(np.isinf(final_log_probs)):
         raise ValueError(
             "".join(
                 [
@@ -72,7 +194,11 @@ def _populate_trans_mat(z_scores, peak_center, spread, trans_m, states):
                 ]
             )
         )
-    return trans_1, trans_2
+
+
+def _trans_matrix(i_to_p, p_to_p):
+    """Build the internal/peak transition probability matrix."""
+    return np.array([[1 - i_to_p, i_to_p], [p_to_p, 1 - p_to_p]])
 
 
 def hmm_peaks(z_scores, i_to_p=1 / 1000, p_to_p=1 / 1.5, peak_center=10, spread=2):
@@ -97,33 +223,84 @@ def hmm_peaks(z_scores, i_to_p=1 / 1000, p_to_p=1 / 1.5, peak_center=10, spread=
     Returns
     -------
         -peaks: a 2xn array with the first column being position and the second
-            column being a peak assignment.
+            column being a peak assignment.  It is C ordered float64, as the
+            z_scores are.
     """
-    print("Finding Peaks")
+    logger.debug("Finding Peaks")
+    if len(z_scores) == 0:
+        return np.empty((0, 2))
     max_z = peak_center + spread
     # cap the z scores at peak_center + spread to eliminate very large zscores.
-    trim_zscores = z_scores[:, :]
-    trim_zscores[:, 1] = np.where(z_scores[:, 1] > max_z, max_z, z_scores[:, 1])
-    trans_m = np.asarray(
-        [[(1 - i_to_p), (i_to_p)], [p_to_p, (1 - p_to_p)]]
-    )  # transition probability
-    states = [1, 100]  # how internal and peak are represented in the wig file
-    trans_1, trans_2 = _populate_trans_mat(
-        trim_zscores, peak_center, spread, trans_m, states
+    locs, z_vals = split_reads(z_scores)
+    trim_z = np.where(z_vals > max_z, max_z, z_vals)
+    final_log_probs, trans_2 = _populate_trans_mat(
+        trim_z, peak_center, spread, _trans_matrix(i_to_p, p_to_p), _STATES
     )
-    peaks = np.zeros([len(z_scores), 2])
-    peaks[:, 0] = trim_zscores[:, 0]
     # Now we trace backwards and find the most likely path:
-    max_inds = np.zeros([len(peaks)]).astype(int)
-    max_inds[-1] = int(np.argmax(trans_1[:, len(trans_1)]))
-    peaks[-1, 1] = states[max_inds[-1]]
-    for index in reversed(list(range(1, len(peaks)))):
-        max_inds[index - 1] = trans_2[max_inds[index], index]
-        peaks[index - 1, 1] = states[max_inds[index - 1]]
-    print(f"Found {sum(peaks[:,1] == states[1])} Peaks")
+    max_inds = _viterbi_backtrace(final_log_probs, trans_2)
+    peaks = np.column_stack((locs, _STATES[max_inds])).astype(np.float64, copy=False)
+    logger.debug("Found %d Peaks", np.count_nonzero(peaks[:, 1] == _STATES[1]))
     return peaks
 
 
+def hmm_peaks_batch(
+    z_scores_list, i_to_p=1 / 1000, p_to_p=1 / 1.5, peak_center=10, spread=2
+):
+    """Fit peaks to several z_scores data sets at once using the vertibi algorithm.
+
+    The tracks (eg chromosomes or replicates) share one set of parameters and
+    are run in parallel across the available cores.
+
+    Parameters
+    ----------
+        -z_scores_list (list of 2xn arrays): the z_scores of each track.
+        -i_to_p, p_to_p, peak_center, spread: as for hmm_peaks.
+
+    Returns
+    -------
+        -peaks_list (list of 2xn arrays): the peaks of each track, as hmm_peaks
+            would return them.
+    """
+    logger.debug("Finding Peaks in %d tracks", len(z_scores_list))
+    max_z = peak_center + spread
+    lengths = np.array([len(z_scores) for z_scores in z_scores_list], dtype=np.int64)
+    log_probs = np.zeros((len(z_scores_list), lengths.max(initial=1), len(_STATES)))
+    for b, z_scores in enumerate(z_scores_list):
+        # cap the z scores at peak_center + spread as hmm_peaks does.
+        z_vals = split_reads(z_scores)[1]
+        trim_z = np.where(z_vals > max_z, max_z, z_vals)
+        log_probs[b, : len(z_scores), 0] = norm.logpdf(trim_z)
+        log_probs[b, : len(z_scores), 1] = norm.logpdf(trim_z, peak_center, spread)
+
+    max_inds, final_log_probs = _viterbi_batch(
+        log_probs, lengths, _log_trans(_trans_matrix(i_to_p, p_to_p))
+    )
+    _check_valid_path(final_log_probs)
+
+    peaks_list = []
+    for b, z_scores in enumerate(z_scores_list):
+        peaks = np.column_stack((z_scores[:, 0], _STATES[max_inds[b, : len(z_scores)]]))
+        peaks_list.append(peaks.astype(np.float64, copy=False))
+    return peaks_list
+
+
+def hmm_peaks_by_chrom(z_score_by_chrom, n_procs=1, **kwargs):
+    """Fit peaks to the z_scores of each chromosome using the vertibi algorithm.
+
+    Parameters
+    ----------
+        -z_score_by_chrom (dict): maps chromosome names to 2xn z_scores arrays.
+        -n_procs (integer): the number of processes to spread the chromosomes
+            over.  Each chromosome is independent, so they can run in parallel.
+        -kwargs: any of the hmm_peaks parameters.
+
+    Returns
+    -------
+        -peaks_by_chrom (dict): maps each chromosome name to its 2xn peaks array.
+    """
+    return map_chroms(hmm_peaks, z_score_by_chrom, n_procs, **kwargs)
+
+
 def _make_kink_fig(save_file, seen, exp, pnts, thresh):
     """Create a figure comparing the obs vs exp z score distributions.
 
@@ -135,14 +312,35 @@ def _make_kink_fig(save_file, seen, exp, pnts, thresh):
         - pnts (1xn array) - the z score values/x axis of the plot.
         - thresh (int) - the threshold value which was ultimately selected.
     """
-    plt.plot(pnts, seen, label="Observed")
-    plt.plot(pnts, exp, label="Expected")
-    plt.plot([thresh, thresh], [max(exp) * 10, min(exp) / 10], label="Threshold")
-    plt.yscale("log")
-    plt.ylabel("Number of Positions with Z score Greater than or equal to")
-    plt.xlabel("Z score")
-    plt.legend()
-    plt.savefig(save_file)
+    # matplotlib is slow to import, so only the kink threshold pays for it.  A
+    # standalone Figure renders with Agg and leaves the pyplot state untouched.
+    from matplotlib.figure import Figure
+
+    # Each call draws on its own Figure.  A figure kept at module level would
+    # let two threads thresholding at once mix up each other's plots.
+    fig = Figure()
+    ax = fig.subplots()
+    ax.plot(pnts, seen, label="Observed")
+    ax.plot(pnts, exp, label="Expected")
+    ax.plot([thresh, thresh], [max(exp) * 10, min(exp) / 10], label="Threshold")
+    ax.set_yscale("log")
+    ax.set_ylabel("Number of Positions with Z score Greater than or equal to")
+    ax.set_xlabel("Z score")
+    ax.legend()
+    fig.savefig(save_file)
+
+
+def _count_above(z_vals, pnts):
+    """Count the z_scores strictly greater than each point.
+
+    One sort of the z_scores lets every point be counted by binary search.
+
+    Returns
+    -------
+        -seen (1xm array): number of z_scores above each point.
+    """
+    sorted_z = np.sort(z_vals)
+    return len(sorted_z) - np.searchsorted(sorted_z, pnts, side="right")
 
 
 def _calc_thresh(z_scores, method, kink_img="./kink.png"):
@@ -165,15 +363,13 @@ def _calc_thresh(z_scores, method, kink_img="./kink.png"):
         thresh = round(norm.ppf(1 - p_val), 1)
     elif method == "kink":  # where the num z_scores exceeds exp num by 10000x
         factor_exceed = 10000
-        pnts = np.arange(0, 20, 0.1)
-        seen = [0 for i in range(len(pnts))]
-        exp = [0 for i in range(len(pnts))]
-        thresh = -1
-        for ind, point in enumerate(pnts):
-            seen[ind] = np.sum(z_scores[:, 1] > point)
-            exp[ind] = (1 - norm.cdf(point)) * len(z_scores)
-            if seen[ind] >= factor_exceed * exp[ind] and thresh == -1:
-                thresh = point
+        pnts = _KINK_PNTS
+        seen = _count_above(z_scores[:, 1], pnts)
+        exp = _KINK_TAIL * len(z_scores)
+        # argmax stops at the first point where seen exceeds the expected count
+        exceeds = seen >= factor_exceed * exp
+        first = exceeds.argmax()
+        thresh = pnts[first] if exceeds[first] else -1
 
         _make_kink_fig(kink_img, seen, exp, pnts, thresh)
 
@@ -200,12 +396,18 @@ def thresh_peaks(z_scores, thresh=None, method="kink"):
             automatically calculated.
         - method - the method to use to automatically calculate the z score
             if none is provided.  Default method is "kink"
+
+    Returns
+    -------
+        - peaks - a 2xn array of nt positions and 1 where the z score is above
+            the threshold, 0 elsewhere.  It is C ordered float64.
     """
     if thresh is None:
         thresh = _calc_thresh(z_scores, method)
-    peaks = np.zeros([len(z_scores), 2])
+    peaks = np.empty([len(z_scores), 2])
     peaks[:, 0] = z_scores[:, 0]
-    peaks[:, 1] = (z_scores[:, 1] > thresh).astype(int)
+    # compare straight into the peaks column, without a temporary bool mask
+    np.greater(z_scores[:, 1], thresh, out=peaks[:, 1])
     return peaks
 
 
@@ -224,6 +426,13 @@ def parse_args_make_peaks(args):
                                         fitting method.  Choose "thesh" \
                                         or "hmm"',
     )
+    parser.add_argument(
+        "--n_procs",
+        help="The number of processes to spread\
+                                        the chromosomes of the file over when\
+                                        using the hmm method.  Default = 1",
+        default=1,
+    )
     parser.add_argument(
         "--save_file",
         help="Save the z_scores file as a new\
@@ -238,22 +447,24 @@ def main_make_peaks():
     """Run the main peak making from command line."""
     args = parse_args_make_peaks(sys.argv[1:])
     filename = args.filename
-    z_scores, chrom = open_wig(filename)
+    z_score_by_chrom = open_wig_chroms(filename)
     if args.method == "thresh":
         print(f"Using the thresholding method to find peaks for {filename}")
-        peaks = thresh_peaks(z_scores)
+        peaks_by_chrom = map_chroms(thresh_peaks, z_score_by_chrom)
     elif args.method == "hmm":
         print(f"Using the hmm method to find peaks for {filename}")
-        peaks = hmm_peaks(z_scores)
+        peaks_by_chrom = hmm_peaks_by_chrom(z_score_by_chrom, n_procs=int(args.n_procs))
     else:
-        raise ValueError("{args.method} is not a valid peak finding method, see --help")
+        raise ValueError(
+            f"{args.method} is not a valid peak finding method, see --help"
+        )
     if args.save_file:
         filename = abspath(filename).replace("\\", "/")
         file_loc = filename[: filename.rfind("/")]
         peak_dir = make_new_dir([file_loc, "/Peaks/"])
         file_start = filename[filename.rfind("/") + 1 : filename.rfind(".wig")]
         peak_file = "".join([peak_dir, file_start, "_peaks.wig"])
-        write_wig(peaks, peak_file, chrom)
+        write_wig_chroms(peaks_by_chrom, peak_file)
         print(f"Wrote peaks to {peak_file}")
 
 
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 """Provide general utility functions used in various rendseq analyses."""
 
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import numpy as np
+from numba import config, set_num_threads
 
 
 def find_peak_locs(peaks, new_data):
@@ -43,19 +48,13 @@ def zero_padding(data):
     print("Zero-padding the reads...")
     ind_start = int(data[0, 0])
     ind_end = int(data[-1, 0])
-    indexes = [i for i in range(ind_start, ind_end + 1)]
-    values = [0 for i in range(len(indexes))]
-    cur_ind = 0
-    for ind, bp in enumerate(indexes):
-        while data[cur_ind, 0] < bp:
-            cur_ind += 1
-        if data[cur_ind, 0] == bp:
-            values[ind] = data[cur_ind, 1]
-        else:
-            values[ind] = 0
-    zero_padded_wig = np.zeros([len(indexes), 2])
-    zero_padded_wig[:, 0] = indexes
-    zero_padded_wig[:, 1] = values
+    zero_padded_wig = np.zeros([ind_end - ind_start + 1, 2])
+    zero_padded_wig[:, 0] = np.arange(ind_start, ind_end + 1)
+    # only reads at whole number positions land on the padded positions, and
+    # where a position repeats its first read is kept:
+    on_bp = data[:, 0] == np.floor(data[:, 0])
+    bps, first = np.unique(data[on_bp, 0].astype(int), return_index=True)
+    zero_padded_wig[bps - ind_start, 1] = data[on_bp, 1][first]
     print("Done zero-padding.")
     return zero_padded_wig
 
@@ -89,3 +88,68 @@ def smooth_peaks(peaks_arr, raw_arr):
         )
     print("Done shaving peaks.")
     return smoothed
+
+
+def split_reads(reads):
+    """
+    Split a 2xn reads array into contiguous arrays of positions and values.
+
+    The columns of a 2xn array are strided, so hot loops that only read one of
+    them work on these copies instead.
+
+    Parameters
+    ----------
+        - reads: a 2xn array with the first column being position and the second
+            column being the value at that position (raw read, z_score etc).
+
+    Returns
+    -------
+        - locs: a 1xn array of the positions.
+        - vals: a 1xn float64 array of the values.
+    """
+    reads = np.asarray(reads)
+    locs = np.ascontiguousarray(reads[:, 0])
+    vals = np.ascontiguousarray(reads[:, 1], dtype=np.float64)
+    return locs, vals
+
+
+def _limit_threads(n_threads):
+    """Cap the numba threads of a map_chroms worker process."""
+    set_num_threads(n_threads)
+
+
+def map_chroms(func, reads_by_chrom, n_procs=1, **kwargs):
+    """
+    Apply a function to the reads of each chromosome, optionally in parallel.
+
+    Parameters
+    ----------
+        - func: the function to apply, called as func(reads, **kwargs).  It
+            must be defined at module level so it can be sent to a worker.
+        - reads_by_chrom: a dict mapping chromosome names to 2xn reads arrays.
+        - n_procs: the number of worker processes to spread the chromosomes
+            over.  With 1 (the default) they are processed in this process.
+            Each worker runs the parallel numba kernels with its share of the
+            numba threads (NUMBA_NUM_THREADS, by default one per core).
+        - kwargs: passed on to func.
+
+    Returns
+    -------
+        - results: a dict mapping each chromosome name to the result of func.
+    """
+    func = partial(func, **kwargs)
+    if n_procs == 1 or len(reads_by_chrom) < 2:
+        return {chrom: func(reads) for chrom, reads in reads_by_chrom.items()}
+    # numba's parallel thread pool does not survive a fork, so workers start in
+    # a freshly spawned process rather than as copies of this one.
+    mp_context = multiprocessing.get_context("spawn")
+    # each worker would otherwise start a thread per core for the numba kernels
+    n_threads = max(1, config.NUMBA_NUM_THREADS // n_procs)
+    with ProcessPoolExecutor(
+        max_workers=n_procs,
+        mp_context=mp_context,
+        initializer=_limit_threads,
+        initargs=(n_threads,),
+    ) as executor:
+        results = executor.map(func, reads_by_chrom.values())
+        return dict(zip(reads_by_chrom.keys(), results))
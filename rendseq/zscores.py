@@ -1,40 +1,68 @@
 # -*- coding: utf-8 -*-
-"""Functions needed for z-score transforming raw rendSeq data."""
+"""Functions needed for z-score transforming raw rendSeq data.
+
+z_scores scores all of a track's windows at once in the compiled
+_window_scores kernel.  The per-position score_helper, _l_score_helper and
+_r_score_helper, and the _adjust_up, _adjust_down, _remove_outliers,
+_calc_score and _z_score they call, are reference implementations only: no
+library path uses them, and the tests check the kernel against them.
+"""
 import argparse
 import sys
 import warnings
 from os.path import abspath
 
-from numpy import mean, std, zeros
+import numpy as np
+from numpy import asarray, mean, zeros
+from numba import njit, prange
 
-from rendseq.file_funcs import make_new_dir, open_wig, validate_reads, write_wig
+from rendseq.file_funcs import (
+    make_new_dir,
+    open_wig_chroms,
+    validate_reads,
+    write_wig_chroms,
+)
+from rendseq.utility_funcs import map_chroms, split_reads
+
+# how many windows each parallel task of _window_scores scores in turn
+_WINDOW_CHUNK = 2**14
 
 
 def _adjust_down(cur_ind, target_val, reads):
     """Calculate the lower reads index in range for the z-score calculation."""
     validate_reads(reads)
-    cur_ind = min(cur_ind, len(reads) - 1)
-    while reads[cur_ind, 0] > target_val:
-        cur_ind -= 1
-
-        if cur_ind == 0:
-            break
-    return cur_ind
+    return int(_search_down(cur_ind, target_val, reads[:, 0]))
 
 
 def _adjust_up(cur_ind, target_val, reads):
     """Calculate the higher reads index in range for the z-score calculation."""
     if len(reads) < 1:
         raise ValueError("requires non-empty reads")
+    return int(_search_up(cur_ind, target_val, reads[:, 0]))
+
+
+def _search_down(cur_inds, target_vals, locs):
+    """Find the lower reads indices in range, for arrays of indices and targets.
+
+    Each result is the largest index no higher than its current index whose
+    location is at most the target, or 0 if there is none.  As locs are sorted
+    this is found by binary search rather than by walking down from the
+    current index.
+    """
+    found = np.maximum(np.searchsorted(locs, target_vals, side="right") - 1, 0)
+    return np.minimum(np.minimum(cur_inds, len(locs) - 1), found)
 
-    cur_ind = min(max(cur_ind, 0), len(reads))
 
-    while reads[cur_ind, 0] < target_val:
-        if cur_ind >= len(reads) - 1:
-            break
-        cur_ind += 1
+def _search_up(cur_inds, target_vals, locs):
+    """Find the higher reads indices in range, for arrays of indices and targets.
 
-    return cur_ind
+    Each result is the smallest index no lower than its current index whose
+    location is at least the target, or the last index if there is none.  As
+    locs are sorted this is found by binary search rather than by walking up
+    from the current index.
+    """
+    found = np.minimum(np.searchsorted(locs, target_vals, side="left"), len(locs) - 1)
+    return np.maximum(np.maximum(cur_inds, 0), found)
 
 
 def _z_score(val, v_mean, v_std):
@@ -59,11 +87,15 @@ def _remove_outliers(vals):
             removed.
     """
     normalized_vals = vals
-    if len(vals) > 1:
-        v_mean = mean(vals)
-        v_std = std(vals)
+    # no value can be sqrt(n - 1) or more std from the mean of n values, so
+    # windows of 7 or fewer never have outliers
+    if len(vals) > 7:
+        vals = asarray(vals)
+        # the deviations give the std as np.std finds it, and then the outliers
+        dev = vals - mean(vals)
+        v_std = np.sqrt(mean(dev * dev))
         if v_std != 0:
-            normalized_vals = [v for v in vals if abs(_z_score(v, v_mean, v_std)) < 2.5]
+            normalized_vals = vals[abs(dev) / v_std < 2.5]
 
     return normalized_vals
 
@@ -81,10 +113,14 @@ def _calc_score(vals, min_r, cur_val):
     -------
         -score: the zscore for the current value, or None if insufficent reads
     """
+    vals = asarray(vals)
+    v_sum = vals.sum()
     score = None
-    if sum(vals + cur_val) > min_r:
-        v_mean = mean(vals)
-        v_std = std(vals)
+    if v_sum + vals.size * cur_val > min_r:
+        # reuse the sum for the mean, and the deviations for the std as np.std
+        v_mean = v_sum / vals.size
+        dev = vals - v_mean
+        v_std = np.sqrt(mean(dev * dev))
 
         score = _z_score(cur_val, v_mean, v_std)
 
@@ -94,14 +130,223 @@ def _calc_score(vals, min_r, cur_val):
 def score_helper(start, stop, min_r, reads, i):
     """Find the z-score of reads[i] relative to the subsection of reads.
 
-    Goes from start to stop, with a read cutoff of min_r
+    Goes from start to stop, with a read cutoff of min_r.  This is the
+    reference for _window_scores, which z_scores uses instead.
     """
-    reads_outlierless = _remove_outliers(list(reads[start:stop, 1]))
+    reads_outlierless = _remove_outliers(reads[start:stop, 1])
     return _calc_score(reads_outlierless, min_r, reads[i, 1])
 
 
+def _compact_vals(vals):
+    """Return vals as float32 if that loses no precision, else as float64.
+
+    Raw read counts are integers well inside float32's exact range, so the
+    values _window_scores reads can be stored at half the size.  All the sums
+    over them are still accumulated in float64.
+    """
+    vals = np.asarray(vals, dtype=np.float64)
+    vals_32 = vals.astype(np.float32)
+    if np.array_equal(vals_32, vals):
+        return vals_32
+    return vals
+
+
+@njit(cache=True)
+def _sums_are_exact(vals):
+    """Check that every sum of vals and of their squares is exact in float64."""
+    biggest = 0.0
+    for v in vals:
+        if v != np.floor(v):
+            return False
+        biggest = max(biggest, abs(v))
+    return biggest * biggest * len(vals) < 2.0**53
+
+
+@njit(cache=True)
+def _sums_stats(s_1, s_2, n_vals):
+    """Find the mean and std from the exact sum and sum of squares of n_vals.
+
+    The variance is found from n_vals * s_2 - s_1 ** 2, which is also exact
+    while both terms are below 2 ** 53, so it is rounded only once.
+    """
+    if n_vals == 0:
+        return np.nan, np.nan
+    return s_1 / n_vals, np.sqrt((n_vals * s_2 - s_1 * s_1) / (n_vals * n_vals))
+
+
+@njit(cache=True)
+def _kept_stats(win, o_mean, o_std):
+    """Find the mean, std, sum and count of the values of win kept.
+
+    A value is kept if it is less than 2.5 o_std from o_mean, or always when
+    o_std is 0.  The mean and std are nan if no value is kept.
+    """
+    w_sum = 0.0
+    n_vals = 0
+    for v in win:
+        if o_std == 0 or abs(v - o_mean) / o_std < 2.5:
+            w_sum += v
+            n_vals += 1
+    if n_vals == 0:
+        return np.nan, np.nan, w_sum, n_vals
+    w_mean = w_sum / n_vals
+    w_var = 0.0
+    for v in win:
+        if o_std == 0 or abs(v - o_mean) / o_std < 2.5:
+            w_var += (v - w_mean) * (v - w_mean)
+    return w_mean, np.sqrt(w_var / n_vals), w_sum, n_vals
+
+
+@njit(nogil=True, cache=True)
+def _score_windows(vals, starts, stops, cur_vals, min_r, scores, valid):
+    """Score a run of windows in order, filling in scores and valid.
+
+    Read counts are whole numbers, so their sums are exact in float64.  For
+    those the sum and sum of squares of each window are kept as running
+    totals, adding and dropping values as the window slides, along with
+    monotonic queues of the window's largest and smallest values.  The window
+    is then only rescanned when one of those is an outlier.  Other values are
+    summed afresh for every window, as running totals of them would pick up
+    rounding error.
+    """
+    lo = hi = 0
+    s_1 = s_2 = 0.0
+    # indices of the window's decreasing maxima and increasing minima.  Between
+    # resets these, like the running totals, only ever hold distinct reads from
+    # the windows' span, so the totals are exact if the span's reads are.
+    span = 0
+    running = False
+    if len(starts) > 0:
+        first = starts.min()
+        span = max(np.maximum(stops, starts).max() - first, 0)
+        running = _sums_are_exact(vals[first : first + span])
+    max_q = np.empty(span, dtype=np.int64)
+    min_q = np.empty(span, dtype=np.int64)
+    max_h = max_t = min_h = min_t = 0
+    for w in range(len(starts)):
+        start = starts[w]
+        stop = max(stops[w], start)
+        win = vals[start:stop]
+        n_vals = len(win)
+
+        if running:
+            if start < lo or start > hi or stop < hi:
+                lo = hi = start
+                s_1 = s_2 = 0.0
+                max_h = max_t = min_h = min_t = 0
+            for k in range(hi, stop):
+                s_1 += vals[k]
+                s_2 += np.float64(vals[k]) ** 2
+                while max_t > max_h and vals[max_q[max_t - 1]] <= vals[k]:
+                    max_t -= 1
+                max_q[max_t] = k
+                max_t += 1
+                while min_t > min_h and vals[min_q[min_t - 1]] >= vals[k]:
+                    min_t -= 1
+                min_q[min_t] = k
+                min_t += 1
+            for k in range(lo, start):
+                s_1 -= vals[k]
+                s_2 -= np.float64(vals[k]) ** 2
+            while max_h < max_t and max_q[max_h] < start:
+                max_h += 1
+            while min_h < min_t and min_q[min_h] < start:
+                min_h += 1
+            lo, hi = start, stop
+        o_sum = s_1
+        if running and n_vals * s_2 < 2.0**53 and s_1 * s_1 < 2.0**53:
+            o_mean, o_std = _sums_stats(s_1, s_2, n_vals)
+        else:
+            o_mean, o_std, o_sum, _ = _kept_stats(win, 0.0, 0.0)
+
+        # _remove_outliers: drop values 2.5 std from the mean, if any spread
+        if n_vals < 2 or o_std == 0:
+            o_std = 0.0
+
+        # _calc_score on the remaining values, which are all of them in windows
+        # of 7 or fewer, as in _remove_outliers:
+        if n_vals < 8:
+            w_mean, w_std, w_sum = o_mean, o_std, o_sum
+        elif running and (
+            o_std == 0
+            or abs(vals[max_q[max_h]] - o_mean) / o_std < 2.5
+            and abs(vals[min_q[min_h]] - o_mean) / o_std < 2.5
+        ):
+            w_mean, w_std, w_sum = o_mean, o_std, s_1
+        else:
+            w_mean, w_std, w_sum, n_vals = _kept_stats(win, o_mean, o_std)
+        cur = cur_vals[w]
+        valid[w] = w_sum + n_vals * cur > min_r
+        if n_vals == 0:
+            scores[w] = np.nan
+        elif w_std != 0:
+            scores[w] = (cur - w_mean) / w_std
+
+
+@njit(
+    [
+        "(f4[::1], i8[::1], i8[::1], f8[::1], f8)",
+        "(f8[::1], i8[::1], i8[::1], f8[::1], f8)",
+    ],
+    parallel=True,
+    nogil=True,
+    cache=True,
+)
+def _window_scores_kernel(vals, starts, stops, cur_vals, min_r):
+    """Score the windows of _window_scores in parallel chunks.
+
+    The windows are independent, so they are split into chunks of
+    _WINDOW_CHUNK that are scored in parallel, each by _score_windows.  It is
+    compiled for its signatures when the module is imported, so takes only the
+    dtypes _window_scores coerces its arguments to.
+    """
+    scores = np.zeros(len(starts))
+    valid = np.zeros(len(starts), dtype=np.bool_)
+    for c in prange((len(starts) + _WINDOW_CHUNK - 1) // _WINDOW_CHUNK):
+        a = c * _WINDOW_CHUNK
+        b = min(a + _WINDOW_CHUNK, len(starts))
+        _score_windows(
+            vals,
+            starts[a:b],
+            stops[a:b],
+            cur_vals[a:b],
+            min_r,
+            scores[a:b],
+            valid[a:b],
+        )
+    return scores, valid
+
+
+def _window_scores(vals, starts, stops, cur_vals, min_r):
+    """Compiled score_helper over many windows of reads at once.
+
+    Parameters
+    ----------
+        -vals (1xn array): the raw read values.
+        -starts, stops (1xm arrays): each window is vals[starts[k]:stops[k]].
+        -cur_vals (1xm array): the value each window's z score is calculated for.
+        -min_r: the minumum number of reads needed to calculate score
+
+    Returns
+    -------
+        -scores (1xm array): the z score for each window.
+        -valid (1xm bool array): False where score_helper would return None.
+    """
+    # the kernel only has float32/float64 values and int64 bounds compiled, and
+    # the default integer is int32 on some platforms
+    if np.asarray(vals).dtype != np.float32:
+        vals = np.asarray(vals, dtype=np.float64)
+    return _window_scores_kernel(
+        np.ascontiguousarray(vals),
+        np.ascontiguousarray(starts, dtype=np.int64),
+        np.ascontiguousarray(stops, dtype=np.int64),
+        np.ascontiguousarray(cur_vals, dtype=np.float64),
+        float(min_r),
+    )
+
+
 def validate_gap_window(gap, w_sz):
-    """Check that gap and window size are reasonable in r/l_score_helper."""
+    """Check that gap and window size are reasonable before scoring a track."""
     if w_sz < 1:
         raise ValueError("Window size must be larger than 1 to find a z-score")
     if gap < 0:
@@ -112,7 +357,7 @@ def validate_gap_window(gap, w_sz):
 
 def _l_score_helper(gap, w_sz, min_r, reads, i):
     """Find the z_score based on reads to the left of the current pos."""
-    validate_gap_window(gap, w_sz)
+    # gap and w_sz are validated by the caller, once per track
     l_start = _adjust_up(i - (gap + w_sz), reads[i, 0] - (gap + w_sz), reads)
     l_stop = _adjust_up(i - gap, reads[i, 0] - gap, reads)
     return score_helper(l_start, l_stop, min_r, reads, i)
@@ -120,7 +365,7 @@ def _l_score_helper(gap, w_sz, min_r, reads, i):
 
 def _r_score_helper(gap, w_sz, min_r, reads, i):
     """Find the z_score based on reads to the right of the current pos."""
-    validate_gap_window(gap, w_sz)
+    # gap and w_sz are validated by the caller, once per track
     r_start = _adjust_down(i + gap, reads[i, 0] + gap, reads)
     r_stop = _adjust_down(i + gap + w_sz, reads[i, 0] + gap + w_sz, reads)
     return score_helper(r_start, r_stop, min_r, reads, i)
@@ -145,41 +390,63 @@ def z_scores(reads, gap=5, w_sz=50, min_r=20):
     Returns
     -------
         -z_score (2xn array): a 2xn array with the first column being position
-            and the second column being the z_score.
+            and the second column being the z_score.  It is C ordered float64,
+            so the columns can be compared or handed on without a copy.
     """
+    validate_gap_window(gap, w_sz)
     # make array of zscores - same length as raw reads, trimming based on window size:
     z_score = zeros([len(reads) - 2 * (gap + w_sz), 2])
 
+    # searchsorted needs contiguous locs, so split the columns once up front
+    locs, vals = split_reads(reads)
+
     # first column of return array is the location of the raw reads
-    z_score[:, 0] = reads[gap + w_sz : len(reads) - (gap + w_sz), 0]
-
-    # Iterate through each valid read, recording z-score
-    for i in range((gap + w_sz + 1), (len(reads) - (gap + w_sz))):
-        # calculate the z score with values from the left:
-        l_score = _l_score_helper(gap, w_sz, min_r, reads, i)
-        # calculate z score with reads from the right:
-        r_score = _r_score_helper(gap, w_sz, min_r, reads, i)
-
-        # The location in which this z-score should go into the final array
-        i_score_pos = i - (gap + w_sz)
-
-        # set the zscore to be the smaller valid score of the left/right scores
-        # If neither score is valid, Z-score is 0
-        z_score[i_score_pos, 1] = 0
-        if l_score is not None:
-            if r_score is not None:
-                z_score[i_score_pos, 1] = (
-                    r_score if abs(r_score) < abs(l_score) else l_score
-                )
-            else:
-                z_score[i_score_pos, 1] = l_score
-
-        elif r_score is not None:
-            z_score[i_score_pos, 1] = r_score
+    z_score[:, 0] = locs[gap + w_sz : len(reads) - (gap + w_sz)]
+
+    # the window bounds for each valid read, as in _l/_r_score_helper
+    inds = np.arange((gap + w_sz + 1), (len(reads) - (gap + w_sz)))
+    l_start = _search_up(inds - (gap + w_sz), locs[inds] - (gap + w_sz), locs)
+    l_stop = _search_up(inds - gap, locs[inds] - gap, locs)
+    r_start = _search_down(inds + gap, locs[inds] + gap, locs)
+    r_stop = _search_down(inds + gap + w_sz, locs[inds] + gap + w_sz, locs)
+
+    # calculate the z scores with values from the left and from the right:
+    cur_vals = vals[inds]
+    vals = _compact_vals(vals)
+    l_score, l_valid = _window_scores(vals, l_start, l_stop, cur_vals, min_r)
+    r_score, r_valid = _window_scores(vals, r_start, r_stop, cur_vals, min_r)
+
+    # set the zscore to be the smaller valid score of the left/right scores
+    # If neither score is valid, Z-score is 0
+    z_score[inds - (gap + w_sz), 1] = np.where(
+        l_valid,
+        np.where(r_valid & (abs(r_score) < abs(l_score)), r_score, l_score),
+        np.where(r_valid, r_score, 0),
+    )
 
     return z_score
 
 
+def z_scores_by_chrom(reads_by_chrom, gap=5, w_sz=50, min_r=20, n_procs=1):
+    """Perform modified z-score transformation of each chromosome's reads.
+
+    Parameters
+    ----------
+        -reads_by_chrom (dict): maps chromosome names to 2xn raw rendseq reads
+        -gap, w_sz, min_r: as for z_scores.
+        -n_procs (integer): the number of processes to spread the chromosomes
+            over.  Each chromosome is independent, so they can run in parallel.
+
+    Returns
+    -------
+        -z_score_by_chrom (dict): maps each chromosome name to its 2xn z_score
+            array.
+    """
+    return map_chroms(
+        z_scores, reads_by_chrom, n_procs, gap=gap, w_sz=w_sz, min_r=min_r
+    )
+
+
 def parse_args_zscores(args):
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(
@@ -221,6 +488,13 @@ def parse_args_zscores(args):
                                         the window.  Default is 20",
         default=20,
     )
+    parser.add_argument(
+        "--n_procs",
+        help="n_procs (integer): the number of\
+                                        processes to spread the chromosomes\
+                                        of the file over.  Default is 1",
+        default=1,
+    )
     parser.add_argument(
         "--save_file",
         help="Save the z_scores file as a new\
@@ -242,9 +516,13 @@ def main_zscores():
     # Calculate z-scores
     filename = args.filename
     print(f"Calculating zscores for file {filename}.")
-    reads, chrom = open_wig(filename)
-    z_score = z_scores(
-        reads, gap=int(args.gap), w_sz=int(args.w_sz), min_r=int(args.min_r)
+    reads_by_chrom = open_wig_chroms(filename)
+    z_score_by_chrom = z_scores_by_chrom(
+        reads_by_chrom,
+        gap=int(args.gap),
+        w_sz=int(args.w_sz),
+        min_r=int(args.min_r),
+        n_procs=int(args.n_procs),
     )
 
     # Save file, if applicable
@@ -254,7 +532,7 @@ def main_zscores():
         z_score_dir = make_new_dir([file_loc, "/Z_scores"])
         file_start = filename[filename.rfind("/") : filename.rfind(".")]
         z_score_file = "".join([z_score_dir, file_start, "_zscores.wig"])
-        write_wig(z_score, z_score_file, chrom)
+        write_wig_chroms(z_score_by_chrom, z_score_file)
         print(f"Wrote z_scores to {z_score_file}")
 
     print(
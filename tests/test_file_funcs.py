@@ -4,7 +4,14 @@ from mock import patch
 from numpy import array
 from numpy.testing import assert_array_equal
 
-from rendseq.file_funcs import make_new_dir, open_wig, validate_reads, write_wig
+from rendseq.file_funcs import (
+    make_new_dir,
+    open_wig,
+    open_wig_chroms,
+    validate_reads,
+    write_wig,
+    write_wig_chroms,
+)
 
 
 class TestValidateReads:
@@ -124,6 +131,69 @@ class TestOpenWriteWig:
         assert read_file.read() == write_file.read()
 
 
+class TestOpenWriteWigChroms:
+    def test_open_wig_chroms(self, tmpdir):
+        """open a wig file with two chromosomes"""
+        file = tmpdir.join("file.txt")
+        with open(file, "w") as wigFH:
+            wigFH.write("track type=wiggle_0\n")
+            wigFH.write("variableStep chrom=chrom_a\n")
+            wigFH.write("1\t5\n2\t6\n")
+            wigFH.write("variableStep chrom=chrom_b\n")
+            wigFH.write("3\t8\n109\t1")
+
+        reads_by_chrom = open_wig_chroms(file.strpath)
+
+        assert list(reads_by_chrom) == ["chrom_a", "chrom_b"]
+        assert_array_equal(reads_by_chrom["chrom_a"], array([[1, 5], [2, 6]]))
+        assert_array_equal(reads_by_chrom["chrom_b"], array([[3, 8], [109, 1]]))
+
+    def test_open_wig_chroms_repeated(self, tmpdir):
+        """a chromosome split over two sections is read back as one"""
+        file = tmpdir.join("file.txt")
+        with open(file, "w") as wigFH:
+            wigFH.write("track type=wiggle_0\n")
+            wigFH.write("variableStep chrom=chrom_a\n")
+            wigFH.write("1\t5\n\n")
+            wigFH.write("variableStep chrom=chrom_b\n")
+            wigFH.write("3\t8\n")
+            wigFH.write("variableStep chrom=chrom_a\n")
+            wigFH.write("2\t6\n")
+
+        reads_by_chrom = open_wig_chroms(file.strpath)
+
+        assert list(reads_by_chrom) == ["chrom_a", "chrom_b"]
+        assert_array_equal(reads_by_chrom["chrom_a"], array([[1, 5], [2, 6]]))
+        assert_array_equal(reads_by_chrom["chrom_b"], array([[3, 8]]))
+
+    def test_open_wig_chroms_malformatted(self, tmpdir):
+        """open a wig file without any chromosomes"""
+        file = tmpdir.join("file.txt")
+        with open(file, "w") as wigFH:
+            wigFH.write("this is definitely\n")
+            wigFH.write("not a proper wig file")
+
+        with pytest.raises(ValueError):
+            open_wig_chroms(file.strpath)
+
+    def test_open_then_write_chroms(self, tmpdir):
+        """If you read a file, and then write it, it should look the same"""
+        read_file = tmpdir.join("read_file.txt")
+        with open(read_file, "w") as wigFH:
+            wigFH.write("track type=wiggle_0\n")
+            wigFH.write("variableStep chrom=chrom_a\n")
+            wigFH.write("1\t5.0\n2\t6.0\n")
+            wigFH.write("variableStep chrom=chrom_b\n")
+            wigFH.write("3\t8.0\n109\t1.0\n")
+
+        reads_by_chrom = open_wig_chroms(read_file.strpath)
+
+        write_file = tmpdir.join("write_file.txt")
+        write_wig_chroms(reads_by_chrom, write_file.strpath)
+
+        assert read_file.read() == write_file.read()
+
+
 @patch("rendseq.file_funcs.mkdir")
 def test_make_new_dir(mock_mkdir):
     """Mock making a new directory"""
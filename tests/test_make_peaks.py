@@ -1,20 +1,39 @@
 # -*- coding: utf-8 -*-
+import logging
 import sys
+import warnings
 from os import remove
 from os.path import exists
 
 import pytest
 from mock import patch
-from numpy import array, ndim, where
+from numpy import (
+    arange,
+    array,
+    asfortranarray,
+    empty,
+    float64,
+    full,
+    inf,
+    int8,
+    log,
+    stack,
+    where,
+    zeros,
+)
 from numpy.random import normal
 from numpy.testing import assert_array_almost_equal, assert_array_equal
+from scipy.stats import norm
 
 from rendseq.file_funcs import write_wig
 from rendseq.make_peaks import (
     _calc_thresh,
+    _count_above,
     _make_kink_fig,
     _populate_trans_mat,
     hmm_peaks,
+    hmm_peaks_batch,
+    hmm_peaks_by_chrom,
     main_make_peaks,
     parse_args_make_peaks,
     thresh_peaks,
@@ -24,12 +43,18 @@ from rendseq.make_peaks import (
 @pytest.fixture
 def z_scores():
     """Define some random z-scores."""
-    return array(
-        [[loc, z] for loc, z in zip(range(1, 1000), normal(0, 1, size=(1, 1000))[0])]
-    )
+    return make_track(normal(0, 1, size=999))
+
+
+# Helper functions
+def make_track(vals):
+    """Pair vals with the positions 1, 2, ... as a 2xn array."""
+    track = empty((len(vals), 2))
+    track[:, 0] = arange(1, len(vals) + 1)
+    track[:, 1] = vals
+    return track
 
 
-# Helper function
 def clean_kink():
     if exists("./kink.png"):
         remove("./kink.png")
@@ -87,14 +112,7 @@ class TestParseArgsAndMain:
             clean_kink()
             out, err = capfd.readouterr()
 
-        assert out == "\n".join(
-            [
-                f"Using the hmm method to find peaks for {file.strpath}",
-                "Finding Peaks",
-                "Calculating Transition Matrix",
-                "Found 0 Peaks\n",
-            ]
-        )
+        assert out == f"Using the hmm method to find peaks for {file.strpath}\n"
 
     def test_main_undefined(self, tmpdir, capfd, regular_argslist, z_scores):
         """Main with undefined method."""
@@ -113,11 +131,11 @@ class TestParseArgsAndMain:
         with patch.object(sys, "argv", regular_argslist):
             with pytest.raises(ValueError) as e_info:
                 main_make_peaks()
-                clean_kink()
-                assert (
-                    e_info.value.args[0]
-                    == "undefined is not a valid peak finding method, see --help"
-                )
+        clean_kink()
+        assert (
+            e_info.value.args[0]
+            == "undefined is not a valid peak finding method, see --help"
+        )
 
     def test_main_defaults(self, tmpdir, capfd, z_scores):
         # Create a wig file with the z_scores() fixture
@@ -157,73 +175,172 @@ class TestParseArgsAndMain:
 
         assert args.filename == "test_file"
         assert args.method == "thresh"
+        assert args.n_procs == 1
         assert args.save_file
 
 
 class TestPopulateTransMat:
     # TODO: Need more detailed tests
-    def test_populate_trans_mat(self, capfd, z_scores):
-        matricies = _populate_trans_mat(
-            z_scores, 10, 2, array([[0.5, 0.5], [0.5, 0.5]]), [1, 100]
+    def test_populate_trans_mat(self, caplog, z_scores):
+        caplog.set_level(logging.DEBUG, logger="rendseq.make_peaks")
+        final_log_probs, trans_2 = _populate_trans_mat(
+            z_scores[:, 1], 10, 2, array([[0.5, 0.5], [0.5, 0.5]]), [1, 100]
         )
 
-        assert ndim(matricies) == 3
+        assert final_log_probs.shape == (2,)
+        assert trans_2.shape == (len(z_scores), 2)
+        assert trans_2.dtype == int8
 
-        # Test print output
-        out, err = capfd.readouterr()
-        assert out == "Calculating Transition Matrix\n"
+        # Test log output
+        assert caplog.messages == ["Calculating Transition Matrix"]
+
+    def test_populate_trans_mat_recurrence(self, z_scores):
+        """The compiled forward pass matches the Vertibi recurrence in numpy."""
+        trans_m = array([[0.9, 0.1], [0.6, 0.4]])
+        final_log_probs, trans_2 = _populate_trans_mat(
+            z_scores[:, 1], 10, 2, trans_m, [1, 100]
+        )
+
+        log_trans = log(trans_m)
+        log_probs = stack(
+            [norm.logpdf(z_scores[:, 1]), norm.logpdf(z_scores[:, 1], 10, 2)], axis=1
+        )
+        prev = array([1.0, 1.0])
+        for i in range(1, len(z_scores)):
+            paths = prev[:, None] + log_trans
+            assert_array_equal(trans_2[i], paths.argmax(axis=0))
+            prev = paths.max(axis=0) + log_probs[i]
+        assert_array_almost_equal(final_log_probs, prev)
 
 
 class TestHmmPeaks:
-    def test_hmm_peaks(self, capfd, z_scores):
+    def test_hmm_peaks(self, caplog, z_scores):
         """A regular set of z scores with a peak."""
+        caplog.set_level(logging.DEBUG, logger="rendseq.make_peaks")
         z_scores[500, 1] = 5
-        peaks_almost_1 = array([[loc, z] for loc, z in zip(range(1, 1000), [1] * 1000)])
+        peaks_almost_1 = make_track(full(999, 1))
         peaks_almost_1[500, 1] = 100
         assert_array_equal(hmm_peaks(z_scores), peaks_almost_1)
 
-        # Test print output
-        out, err = capfd.readouterr()
-        assert out == "Finding Peaks\nCalculating Transition Matrix\nFound 1 Peaks\n"
+        # Test log output
+        assert caplog.messages == [
+            "Finding Peaks",
+            "Calculating Transition Matrix",
+            "Found 1 Peaks",
+        ]
 
-    def test_hmm_peaks_extremePeak_notinCenter(self, capfd, z_scores):
+    def test_hmm_peaks_extremePeak_notinCenter(self, caplog, z_scores):
         """A regular set of z scores with an extreme peak."""
+        caplog.set_level(logging.DEBUG, logger="rendseq.make_peaks")
         z_scores[500, 1] = 10e4
-        peaks_almost_1 = array([[loc, z] for loc, z in zip(range(1, 1000), [1] * 1000)])
+        peaks_almost_1 = make_track(full(999, 1))
         peaks_almost_1[500, 1] = 100
 
         assert_array_equal(hmm_peaks(z_scores), peaks_almost_1)
 
-        # Test print output
-        out, err = capfd.readouterr()
-        assert out == "Finding Peaks\nCalculating Transition Matrix\nFound 1 Peaks\n"
+        # Test log output
+        assert caplog.messages == [
+            "Finding Peaks",
+            "Calculating Transition Matrix",
+            "Found 1 Peaks",
+        ]
+
+    def test_hmm_peaks_last_position(self, z_scores):
+        """The path is traced back from the most likely final state."""
+        z_scores[-1, 1] = 10
+        peaks = hmm_peaks(z_scores)
+        assert peaks[-1, 1] == 100
 
     def test_hmm_peaks_bad_parameters(self, z_scores):
-        """A regular set of z scores with a peak."""
+        """Poor parameters still give a path now emissions are in log space."""
         z_scores[500, 1] = 12
+        peaks = hmm_peaks(
+            z_scores, i_to_p=0.5, p_to_p=0.99, peak_center=100, spread=0.5
+        )
+        assert peaks.shape == z_scores.shape
+        assert_array_equal(peaks[:, 0], z_scores[:, 0])
+
+    def test_hmm_peaks_no_valid_path(self, z_scores):
+        """A z score no state can emit leaves no valid path."""
+        z_scores[500, 1] = -inf
         with pytest.raises(ValueError):
-            hmm_peaks(z_scores, i_to_p=0.5, p_to_p=0.99, peak_center=100, spread=0.5)
+            hmm_peaks(z_scores)
+
+    def test_hmm_peaks_empty(self):
+        """An empty track has no peaks."""
+        assert hmm_peaks(empty((0, 2))).shape == (0, 2)
+
+    def test_hmm_peaks_input_unchanged(self, z_scores):
+        """Capping the z scores doesn't edit the array passed in."""
+        z_scores[500, 1] = 50
+        original = z_scores.copy()
+        hmm_peaks(z_scores)
+        assert_array_equal(z_scores, original)
+
+    def test_hmm_peaks_layout(self, z_scores):
+        """Peaks come back C ordered float64, even from column ordered z scores."""
+        peaks = hmm_peaks(asfortranarray(z_scores))
+        assert peaks.dtype == float64
+        assert peaks.flags.c_contiguous
+
+    def test_hmm_peaks_i_to_p_is_zero(self, z_scores):
+        """A transition probability of zero means the peak state is never entered."""
+        z_scores[500, 1] = 12
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            peaks = hmm_peaks(z_scores, i_to_p=0)
+        assert_array_equal(peaks[:, 1], 1)
 
     def test_hmm_peaks_p_to_p_is_one(self, z_scores):
         """A regular set of z scores with a peak."""
         NUM_PNTS = 1000
-        z_scores = array(
-            [
-                [loc, z]
-                for loc, z in zip(
-                    range(1, NUM_PNTS), normal(10, 0.1, size=(1, NUM_PNTS - 1))[0]
-                )
-            ]
-        )
-        all_peaks = array(
-            [[loc, z] for loc, z in zip(range(1, NUM_PNTS), [100] * NUM_PNTS)]
-        )
+        z_scores = make_track(normal(10, 0.1, size=NUM_PNTS - 1))
+        all_peaks = make_track(full(NUM_PNTS - 1, 100))
 
         assert_array_equal(hmm_peaks(z_scores, peak_center=10, spread=0.1), all_peaks)
 
     # TODO: Tests for all of the hmm_peaks parameters
 
 
+class TestHmmPeaksBatch:
+    def test_hmm_peaks_batch(self, z_scores):
+        """Each track gets the peaks hmm_peaks would find."""
+        z_scores[500, 1] = 5
+        short = z_scores[:300].copy()
+        short[-1, 1] = 10
+        tracks = [z_scores, short, z_scores[::-1].copy()]
+        peaks_list = hmm_peaks_batch(tracks)
+        assert len(peaks_list) == len(tracks)
+        for peaks, track in zip(peaks_list, tracks):
+            assert_array_equal(peaks, hmm_peaks(track.copy()))
+
+    def test_hmm_peaks_batch_empty_track(self, z_scores):
+        """An empty track gets no peaks, and the others are unaffected."""
+        z_scores[500, 1] = 5
+        peaks_list = hmm_peaks_batch([empty((0, 2)), z_scores, empty((0, 2))])
+        assert peaks_list[0].shape == (0, 2)
+        assert peaks_list[2].shape == (0, 2)
+        assert_array_equal(peaks_list[1], hmm_peaks(z_scores))
+
+    def test_hmm_peaks_batch_no_valid_path(self, z_scores):
+        """A track without a valid path raises, as in hmm_peaks."""
+        bad = z_scores.copy()
+        bad[500, 1] = -inf
+        with pytest.raises(ValueError):
+            hmm_peaks_batch([z_scores, bad])
+
+
+def test_hmm_peaks_by_chrom(z_scores):
+    """Each chromosome gets the peaks hmm_peaks would find, in parallel or not."""
+    z_scores[500, 1] = 5
+    z_score_by_chrom = {"chrom_a": z_scores, "chrom_b": z_scores[::-1].copy()}
+    for n_procs in [1, 2]:
+        peaks_by_chrom = hmm_peaks_by_chrom(z_score_by_chrom, n_procs=n_procs)
+        assert list(peaks_by_chrom) == ["chrom_a", "chrom_b"]
+        for chrom, chrom_z_scores in z_score_by_chrom.items():
+            assert_array_equal(peaks_by_chrom[chrom], hmm_peaks(chrom_z_scores))
+
+
 def test_make_kink_fig(tmpdir):
     """Just make sure it makes a plot file."""
     file = tmpdir.join("file")
@@ -234,19 +351,17 @@ def test_make_kink_fig(tmpdir):
 class TestThreshPeaks:
     def test_thresh_peaks_highThresh(self, z_scores):
         """Very high threshold."""
-        z_scores_0 = array([[loc, z] for loc, z in zip(range(1, 1000), [0] * 1000)])
+        z_scores_0 = make_track(zeros(999))
         assert_array_equal(thresh_peaks(z_scores, thresh=1e9), z_scores_0)
 
     def test_thresh_peaks_lowThreshold(self, z_scores):
         """A very low threshold."""
-        z_scores_1 = array([[loc, z] for loc, z in zip(range(1, 1000), [1] * 1000)])
+        z_scores_1 = make_track(full(999, 1))
         assert_array_almost_equal(thresh_peaks(z_scores, thresh=-1e9), z_scores_1)
 
     def test_thresh_peaks_threshold(self, z_scores):
         """Test the filtering: threshold is exactly at one point."""
-        z_scores_almost0 = array(
-            [[loc, z] for loc, z in zip(range(1, 1000), [0] * 1000)]
-        )
+        z_scores_almost0 = make_track(zeros(999))
         max_score = max(z_scores[:, 1])
         thresh = max_score - 1e-6
 
@@ -256,6 +371,20 @@ class TestThreshPeaks:
             thresh_peaks(z_scores, thresh=thresh), z_scores_almost0
         )
 
+    def test_thresh_peaks_layout(self, z_scores):
+        """Peaks come back C ordered float64, even from column ordered z scores."""
+        peaks = thresh_peaks(asfortranarray(z_scores), thresh=0)
+        assert peaks.dtype == float64
+        assert peaks.flags.c_contiguous
+
+
+class TestCountAbove:
+    def test_count_above(self, z_scores):
+        """Counts match a direct comparison."""
+        pnts = arange(-3, 3, 0.5)
+        expected = [(z_scores[:, 1] > p).sum() for p in pnts]
+        assert_array_equal(_count_above(z_scores[:, 1], pnts), expected)
+
 
 class TestCalcThresh:
     def test_calc_thresh_default(self, z_scores):
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from numba import config, get_num_threads
+from numpy import array
+from numpy.testing import assert_array_equal
+
+from rendseq.utility_funcs import map_chroms, zero_padding
+
+
+def _num_threads(reads):
+    """Report the numba threads of the process the reads are handled in."""
+    return get_num_threads()
+
+
+class TestZeroPadding:
+    def test_zero_padding_gaps(self, capfd):
+        """Missing positions are filled in with zero reads"""
+        data = array([[3, 5], [4, 2], [7, 9]])
+        assert_array_equal(
+            zero_padding(data),
+            array([[3, 5], [4, 2], [5, 0], [6, 0], [7, 9]]),
+        )
+        out, err = capfd.readouterr()
+        assert out == "Zero-padding the reads...\nDone zero-padding.\n"
+
+    def test_zero_padding_no_gaps(self):
+        """Reads with every position present are unchanged"""
+        data = array([[1, 4.5], [2, 0.5], [3, 7]])
+        assert_array_equal(zero_padding(data), data)
+
+    def test_zero_padding_non_integer(self):
+        """Reads between whole number positions are dropped"""
+        data = array([[1, 4], [2.5, 8], [4, 6]])
+        assert_array_equal(
+            zero_padding(data),
+            array([[1, 4], [2, 0], [3, 0], [4, 6]]),
+        )
+
+    def test_zero_padding_duplicates(self):
+        """The first read at a repeated position is kept"""
+        data = array([[1, 4], [2, 8], [2, 3], [3, 6], [3, 1]])
+        assert_array_equal(
+            zero_padding(data),
+            array([[1, 4], [2, 8], [3, 6]]),
+        )
+
+
+class TestMapChroms:
+    def test_map_chroms(self):
+        """func is applied to the reads of each chromosome"""
+        reads_by_chrom = {"a": array([[1, 2]]), "b": array([[3, 4], [5, 6]])}
+        assert map_chroms(len, reads_by_chrom) == {"a": 1, "b": 2}
+
+    def test_map_chroms_worker_threads(self):
+        """Workers share the numba threads rather than each taking all of them"""
+        reads_by_chrom = {"a": array([[1, 2]]), "b": array([[3, 4]])}
+        n_threads = max(1, config.NUMBA_NUM_THREADS // 2)
+        threads = map_chroms(_num_threads, reads_by_chrom, n_procs=2)
+        assert threads == {"a": n_threads, "b": n_threads}
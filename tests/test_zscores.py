@@ -3,23 +3,41 @@ import sys
 
 import pytest
 from mock import patch
-from numpy import append, array, mean, std
+from numpy import (
+    append,
+    arange,
+    array,
+    float32,
+    float64,
+    int32,
+    int64,
+    mean,
+    stack,
+    std,
+)
+from numpy.random import normal
 from numpy.testing import assert_array_almost_equal, assert_array_equal
 
 from rendseq.file_funcs import write_wig
 from rendseq.zscores import (
+    _WINDOW_CHUNK,
     _adjust_down,
     _adjust_up,
     _calc_score,
+    _compact_vals,
     _l_score_helper,
     _r_score_helper,
     _remove_outliers,
+    _search_down,
+    _search_up,
+    _window_scores,
     _z_score,
     main_zscores,
     parse_args_zscores,
     score_helper,
     validate_gap_window,
     z_scores,
+    z_scores_by_chrom,
 )
 
 
@@ -93,7 +111,7 @@ class TestMainAndParseArgsZscore:
         chrom = "test_chrom"
 
         # Need a larger reads file for defaults
-        reads = array([[a, b] for a, b in zip(range(1, 1000), range(1001, 2000))])
+        reads = stack((arange(1, 1000), arange(1001, 2000)), axis=1)
         write_wig(reads, file.strpath, chrom)
 
         # Modify the argslist with the temporary wig file
@@ -132,6 +150,7 @@ class TestMainAndParseArgsZscore:
         assert args.gap == 5
         assert args.w_sz == 50
         assert args.min_r == 20
+        assert args.n_procs == 1
         assert args.save_file
 
 
@@ -194,16 +213,44 @@ class TestZScores:
             decimal=4,
         )
 
+    def test_z_scores_layout(self, reads):
+        """The z scores come back as one C ordered float64 block"""
+        z_score = z_scores(reads, gap=1, w_sz=3, min_r=0)
+        assert z_score.dtype == float64
+        assert z_score.flags.c_contiguous
+
+    def test_z_scores_gap_zero_warns_once(self, reads):
+        """A zero gap is flagged once per track, not once per position"""
+        with pytest.warns(UserWarning) as record:
+            z_scores(reads, gap=0, w_sz=3, min_r=0)
+        assert len(record) == 1
+
+
+class TestZScoresByChrom:
+    def test_z_scores_by_chrom(self, reads):
+        """Each chromosome is scored as z_scores would, in parallel or not"""
+        reads_by_chrom = {"chrom_a": reads, "chrom_b": reads[::-1] * [-1, 1]}
+        reads_by_chrom["chrom_b"][:, 0] += 300
+        for n_procs in [1, 2]:
+            z_score_by_chrom = z_scores_by_chrom(
+                reads_by_chrom, gap=1, w_sz=3, min_r=0, n_procs=n_procs
+            )
+            assert list(z_score_by_chrom) == ["chrom_a", "chrom_b"]
+            for chrom, chrom_reads in reads_by_chrom.items():
+                assert_array_equal(
+                    z_score_by_chrom[chrom],
+                    z_scores(chrom_reads, gap=1, w_sz=3, min_r=0),
+                )
+
 
 class TestLWScoreHelper:
     def test_l_score_helper_nogap(self, reads):
         """No gap"""
         min_r = 0
         i = 2
-        with pytest.warns(UserWarning):
-            assert _l_score_helper(0, 1, min_r, reads, i) == score_helper(
-                1, 2, min_r, reads, i
-            )
+        assert _l_score_helper(0, 1, min_r, reads, i) == score_helper(
+            1, 2, min_r, reads, i
+        )
 
     def test_l_score_helper_gap(self, reads):
         """A small gap"""
@@ -225,10 +272,9 @@ class TestLWScoreHelper:
         """No gap"""
         min_r = 0
         i = 2
-        with pytest.warns(UserWarning):
-            assert _r_score_helper(0, 1, min_r, reads, i) == score_helper(
-                2, 3, min_r, reads, i
-            )
+        assert _r_score_helper(0, 1, min_r, reads, i) == score_helper(
+            2, 3, min_r, reads, i
+        )
 
     def test_r_score_helper_gap(self, reads):
         """A small gap"""
@@ -285,7 +331,7 @@ class TestScoreHelper:
         min_r = 1
         i = 1
         assert score_helper(0, 4, 0, reads, 1) == pytest.approx(
-            _calc_score(list(reads[0:4, 1]), min_r, reads[i, 1])
+            _calc_score(reads[0:4, 1], min_r, reads[i, 1])
         )
 
     def test_score_helper_outlier(self, reads):
@@ -293,8 +339,72 @@ class TestScoreHelper:
         min_r = 1
         i = 1
         assert score_helper(0, 4, 0, reads + [800], 1) == pytest.approx(
-            _calc_score(list(reads[0:4, 1]), min_r, reads[i, 1])
+            _calc_score(reads[0:4, 1], min_r, reads[i, 1])
+        )
+
+
+class TestWindowScores:
+    def test_window_scores_match_score_helper(self, reads):
+        """Each window scores the same as score_helper would"""
+        starts = array([0, 0, 2, 5, 9, 4], dtype=int64)
+        stops = array([4, 12, 7, 13, 9, 5], dtype=int64)
+        cur_inds = array([1, 2, 6, 4, 10, 3], dtype=int64)
+        for min_r in [0, 30, 1e8]:
+            vals = reads[:, 1].astype(float)
+            scores, valid = _window_scores(vals, starts, stops, vals[cur_inds], min_r)
+            for k in range(len(starts)):
+                expected = score_helper(starts[k], stops[k], min_r, reads, cur_inds[k])
+                if expected is None:
+                    assert not valid[k]
+                else:
+                    assert valid[k]
+                    assert scores[k] == pytest.approx(expected)
+
+    def test_window_scores_sliding(self, reads):
+        """Sliding windows kept as running sums score as score_helper would"""
+        vals = append(reads[:, 1], [90, 4, 4, 4, 4, 4, 7]).astype(float)
+        starts = array([i // 2 for i in range(2 * len(vals) - 8)], dtype=int64)
+        stops = starts + array([3, 4] * (len(starts) // 2), dtype=int64)
+        cur_inds = (starts + 2) % len(vals)
+        long_reads = array([range(len(vals)), vals]).T
+        for shift in [0, 0.5]:  # whole read counts use the running sums
+            scores, valid = _window_scores(
+                vals + shift, starts, stops, vals[cur_inds] + shift, 0
+            )
+            for k in range(len(starts)):
+                expected = score_helper(
+                    starts[k], stops[k], 0, long_reads + [0, shift], cur_inds[k]
+                )
+                assert valid[k] == (expected is not None)
+                assert scores[k] == pytest.approx(expected)
+
+    def test_window_scores_int32_bounds(self, reads):
+        """Default integer bounds, int32 on some platforms, are accepted"""
+        vals = reads[:, 1].astype(float)
+        starts = array([0, 2, 5], dtype=int64)
+        stops = array([4, 7, 13], dtype=int64)
+        expected = _window_scores(vals, starts, stops, vals[:3], 0)
+        scores, valid = _window_scores(
+            reads[:, 1].astype(int32),
+            starts.astype(int32),
+            stops.astype(int32),
+            vals[:3],
+            0,
         )
+        assert_array_equal(scores, expected[0])
+        assert_array_equal(valid, expected[1])
+
+    def test_window_scores_chunks(self):
+        """Windows either side of a parallel chunk boundary score correctly"""
+        vals = normal(20, 5, 3 * _WINDOW_CHUNK).round()
+        starts = arange(2 * _WINDOW_CHUNK, dtype=int64)
+        stops = starts + 50
+        long_reads = array([range(len(vals)), vals]).T
+        scores, valid = _window_scores(vals, starts, stops, vals[starts], 20)
+        for k in range(_WINDOW_CHUNK - 3, _WINDOW_CHUNK + 3):
+            expected = score_helper(starts[k], stops[k], 20, long_reads, k)
+            assert valid[k]
+            assert scores[k] == pytest.approx(expected)
 
 
 class TestCalcScore:
@@ -347,6 +457,13 @@ class TestRemoveOutliers:
 
         assert_array_equal(_remove_outliers(test_array), test_array[0:-1])
 
+    def test_remove_outliers_short(self):
+        """Seven values are too few for any to be 2.5 stds from the mean"""
+        test_array = append(array([0] * 6), [100])
+        assert_array_equal(_remove_outliers(test_array), test_array)
+        test_array = append(array([0] * 7), [100])
+        assert_array_equal(_remove_outliers(test_array), test_array[0:-1])
+
 
 class TestAdjustDown:
     def test_adjust_down_empty(self):
@@ -400,3 +517,41 @@ class TestAdjustUp:
     def test_adjust_up_oob(self, reads):
         """Current is lower than any index"""
         assert _adjust_up(2, 0, reads) == 2
+
+
+class TestSearchUpDown:
+    def test_search_down_matches_walk(self, reads):
+        """Binary search agrees with walking down the reads"""
+        curs, targets = zip(*[(c, t) for c in range(1, 14) for t in range(-2, 220, 3)])
+        expected = [
+            max([i for i in range(c + 1) if reads[i, 0] <= t], default=0)
+            for c, t in zip(curs, targets)
+        ]
+        assert_array_equal(
+            _search_down(array(curs), array(targets), reads[:, 0]), expected
+        )
+
+    def test_search_up_matches_walk(self, reads):
+        """Binary search agrees with walking up the reads"""
+        curs, targets = zip(*[(c, t) for c in range(0, 14) for t in range(-2, 220, 3)])
+        expected = [
+            min([i for i in range(c, len(reads)) if reads[i, 0] >= t], default=13)
+            for c, t in zip(curs, targets)
+        ]
+        assert_array_equal(
+            _search_up(array(curs), array(targets), reads[:, 0]), expected
+        )
+
+
+class TestCompactVals:
+    def test_compact_vals_counts(self, reads):
+        """Integer counts are stored as float32"""
+        vals = _compact_vals(reads[:, 1])
+        assert vals.dtype == float32
+        assert_array_equal(vals, reads[:, 1])
+
+    def test_compact_vals_precise(self):
+        """Values float32 can't hold exactly stay float64"""
+        vals = _compact_vals(array([0.1, 2.5, 1e8 + 1]))
+        assert vals.dtype == float64
+        assert_array_equal(vals, [0.1, 2.5, 1e8 + 1])